@@ -1,71 +1,95 @@
 import asyncio
+import collections
+import logging
 import httpx
 from contextlib import asynccontextmanager
 from .config import config
 
+logger = logging.getLogger(__name__)
+
+# Upper bound on login requests in flight during startup
+LOGIN_CONCURRENCY = 10
+
 class AccountManager:
     def __init__(self):
-        self.account_queue = asyncio.Queue()
+        # Idle accounts, and futures of requests waiting for one
+        self._accounts_available = collections.deque()
+        self._waiters = collections.deque()
+        self._login_semaphore = asyncio.Semaphore(LOGIN_CONCURRENCY)
         self.accounts = config.accounts
-        print(f"AccountManager loaded with {len(self.accounts)} accounts from config.")
+        logger.info("AccountManager loaded with %d accounts from config.", len(self.accounts))
 
     async def _login_and_get_token(self, session: httpx.AsyncClient, account):
-        print(f"Attempting to log in for {account.email or account.mobile}...")
-        payload = {
-            "password": account.password,
-            "device_id": "deepseek_to_api_accounts",
-            "os": "android",
-        }
-        if account.email:
-            payload["email"] = account.email
-        else:
-            payload["mobile"] = account.mobile
+        async with self._login_semaphore:
+            logger.info("Attempting to log in for %s...", account.email or account.mobile)
+            payload = {
+                "password": account.password,
+                "device_id": "deepseek_to_api_accounts",
+                "os": "android",
+            }
+            if account.email:
+                payload["email"] = account.email
+            else:
+                payload["mobile"] = account.mobile
         
-        try:
-            resp = await session.post(
-                "https://chat.deepseek.com/api/v0/users/login",
-                json=payload,
-                # httpx does not support impersonate, but we can set headers
-                headers={"User-Agent": "DeepSeek/1.0.13 Android/35"}
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            if data.get("code") == 0:
-                token = data["data"]["biz_data"]["user"]["token"]
-                print(f"Token acquired for {account.email or account.mobile}.")
-                return token
-            print(f"Login failed for {account.email or account.mobile}: {data.get('msg')}")
-            return None
-        except Exception as e:
-            print(f"Login request failed for {account.email or account.mobile}: {e}")
-            return None
+            try:
+                resp = await session.post(
+                    "https://chat.deepseek.com/api/v0/users/login",
+                    json=payload,
+                )
+                resp.raise_for_status()
+                data = resp.json()
+                if data.get("code") == 0:
+                    token = data["data"]["biz_data"]["user"]["token"]
+                    logger.info("Token acquired for %s.", account.email or account.mobile)
+                    return token
+                logger.warning("Login failed for %s: %s", account.email or account.mobile, data.get("msg"))
+                return None
+            except Exception as e:
+                logger.warning("Login request failed for %s: %s", account.email or account.mobile, e)
+                return None
 
     async def initialize_tokens(self, session: httpx.AsyncClient):
-        tasks = []
-        for acc in self.accounts:
-            if not acc.token:
-                tasks.append(self._login_and_get_token(session, acc))
-            else:
-                tasks.append(asyncio.create_task(asyncio.sleep(0, result=acc.token)))
+        # Accounts with a prefetched token need no request at all
+        pending = [acc for acc in self.accounts if not acc.token]
+        results = await asyncio.gather(
+            *(self._login_and_get_token(session, acc) for acc in pending)
+        )
+        for acc, token in zip(pending, results):
+            acc.token = token
 
-        results = await asyncio.gather(*tasks)
-        
-        for i, token in enumerate(results):
-            if token:
-                self.accounts[i].token = token
-                await self.account_queue.put(self.accounts[i])
+        for acc in self.accounts:
+            if acc.token:
+                self.release_account(acc)
         
-        print(f"AccountManager initialized with {self.account_queue.qsize()} active accounts.")
+        logger.info("AccountManager initialized with %d active accounts.", len(self._accounts_available))
 
     async def get_account(self):
-        print("Waiting for an available account...")
-        account = await self.account_queue.get()
-        print("Account acquired.")
+        if self._accounts_available:
+            account = self._accounts_available.popleft()
+        else:
+            logger.debug("Waiting for an available account...")
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                account = await waiter
+            except asyncio.CancelledError:
+                # Cancelled after being handed an account: pass it on
+                if waiter.done() and not waiter.cancelled():
+                    self.release_account(waiter.result())
+                raise
+        logger.debug("Account acquired.")
         return account
 
     def release_account(self, account):
-        self.account_queue.put_nowait(account)
-        print("Account released.")
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(account)
+                break
+        else:
+            self._accounts_available.append(account)
+        logger.debug("Account released.")
 
     @asynccontextmanager
     async def managed_account(self):
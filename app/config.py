@@ -1,27 +1,29 @@
-import json
-from pydantic import BaseModel, Field
-from typing import List
+import logging
+import msgspec
+from typing import FrozenSet, List, Optional
 
-class Account(BaseModel):
-    email: str = None
-    mobile: str = None
+logger = logging.getLogger(__name__)
+
+class Account(msgspec.Struct, kw_only=True):
+    email: Optional[str] = None
+    mobile: Optional[str] = None
     password: str
-    token: str = None
+    token: Optional[str] = None
 
-class Settings(BaseModel):
-    accounts: List[Account] = Field(default_factory=list)
-    api_keys: List[str] = Field(default_factory=list)
+class Settings(msgspec.Struct, kw_only=True):
+    accounts: List[Account] = msgspec.field(default_factory=list)
+    # A set, so per-request key checks are O(1)
+    api_keys: FrozenSet[str] = frozenset()
 
 def load_config(path: str = "config.json") -> Settings:
     try:
-        with open(path, "r") as f:
-            data = json.load(f)
-            return Settings(**data)
+        with open(path, "rb") as f:
+            return msgspec.json.decode(f.read(), type=Settings)
     except FileNotFoundError:
-        print(f"Warning: {path} not found. Using default settings.")
+        logger.warning("%s not found. Using default settings.", path)
         return Settings()
     except Exception as e:
-        print(f"Error loading config from {path}: {e}")
+        logger.error("Error loading config from %s: %s", path, e)
         return Settings()
 
 config = load_config()
@@ -1,34 +1,80 @@
+import asyncio
+import concurrent.futures
 import ctypes
 import struct
 import os
-import json
+import threading
 import base64
-from wasmtime import Store, Module, Linker
+import logging
+import orjson
+from wasmtime import Engine, Store, Module, Linker
 import httpx
 from contextlib import asynccontextmanager
 
+logger = logging.getLogger(__name__)
+
 # --- API Configuration ---
 DEEPSEEK_API_BASE = "https://chat.deepseek.com/api/v0"
+_URL_SESSION_CREATE = f"{DEEPSEEK_API_BASE}/chat_session/create"
+_URL_SESSION_DELETE = f"{DEEPSEEK_API_BASE}/chat_session/delete"
+_URL_POW = f"{DEEPSEEK_API_BASE}/chat/create_pow_challenge"
+_URL_COMPLETION = f"{DEEPSEEK_API_BASE}/chat/completion"
 WASM_FILE_PATH = "sha3_wasm_bg.7b9ca65ddd.wasm"
+# Precompiled (serialized) form of the module above, written on first start
+COMPILED_WASM_FILE_PATH = os.path.splitext(WASM_FILE_PATH)[0] + ".cwasm"
+# Sent on every request by the shared http client
+USER_AGENT = "DeepSeek/1.0.13 Android/35"
 BASE_HEADERS = {
     "Host": "chat.deepseek.com",
-    "User-Agent": "DeepSeek/1.0.13 Android/35",
     "Accept": "application/json",
     "Content-Type": "application/json",
     "x-client-platform": "web",
     "x-client-version": "1.2.0-sse-hint",
 }
 
+def _load_pow_module(engine: Engine, wasm_path: str, compiled_path: str) -> Module:
+    if not os.path.exists(wasm_path):
+        raise FileNotFoundError(f"WASM file not found at: {wasm_path}")
+    # Reuse the serialized module when it is newer than the wasm it came from
+    if os.path.exists(compiled_path) and os.path.getmtime(compiled_path) >= os.path.getmtime(wasm_path):
+        try:
+            return Module.deserialize_file(engine, compiled_path)
+        except Exception as e:
+            logger.warning("Discarding unusable precompiled WASM module: %s", e)
+    with open(wasm_path, "rb") as f:
+        module = Module(engine, f.read())
+    try:
+        tmp_path = f"{compiled_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(module.serialize())
+        os.replace(tmp_path, compiled_path)
+    except OSError as e:
+        logger.warning("Could not write precompiled WASM module to %s: %s", compiled_path, e)
+    return module
+
+# Compiled once per process; generators only instantiate it
+POW_ENGINE = Engine()
+POW_MODULE = _load_pow_module(POW_ENGINE, WASM_FILE_PATH, COMPILED_WASM_FILE_PATH)
+
+# SSE framing of the completion stream
+_DATA_PREFIX = b"data:"
+_DONE = b"data: [DONE]"
+# Fragment path -> whether it belongs to the thinking part of the answer
+_PATH_IS_THINKING = {"response/thinking_content": True, "response/content": False}
+
+class Chunk:
+    # One is yielded per stream fragment, so it only carries two slots
+    __slots__ = ("type", "content")
+
+    def __init__(self, type: str, content: str | None = None):
+        self.type = type
+        self.content = content
+
 class PoWGenerator:
     # This class remains synchronous as it's CPU-bound
-    def __init__(self, wasm_path: str):
-        if not os.path.exists(wasm_path):
-            raise FileNotFoundError(f"WASM file not found at: {wasm_path}")
-        self.store = Store()
-        self.linker = Linker(self.store.engine)
-        with open(wasm_path, "rb") as f:
-            wasm_bytes = f.read()
-        module = Module(self.store.engine, wasm_bytes)
+    def __init__(self, engine: Engine, module: Module):
+        self.store = Store(engine)
+        self.linker = Linker(engine)
         self.instance = self.linker.instantiate(self.store, module)
         exports = self.instance.exports(self.store)
         try:
@@ -38,14 +84,20 @@ class PoWGenerator:
             self.wasm_solve = exports["wasm_solve"]
         except KeyError as e:
             raise RuntimeError(f"Could not find required export in WASM module: {e}")
+        self._mem_buf = None
+        self._mem_size = -1
 
-    def _write_memory(self, offset: int, data: bytes):
-        base_addr = ctypes.cast(self.memory.data_ptr(self.store), ctypes.c_void_p).value
-        ctypes.memmove(base_addr + offset, data, len(data))
+    def _memory_buffer(self):
+        # Linear memory only moves when it grows, so the view is rebuilt on size change
+        size = self.memory.data_len(self.store)
+        if size != self._mem_size:
+            base_addr = ctypes.cast(self.memory.data_ptr(self.store), ctypes.c_void_p).value
+            self._mem_buf = (ctypes.c_ubyte * size).from_address(base_addr)
+            self._mem_size = size
+        return self._mem_buf
 
-    def _read_memory(self, offset: int, size: int) -> bytes:
-        base_addr = ctypes.cast(self.memory.data_ptr(self.store), ctypes.c_void_p).value
-        return ctypes.string_at(base_addr + offset, size)
+    def _write_memory(self, offset: int, data: bytes):
+        ctypes.memmove(ctypes.addressof(self._memory_buffer()) + offset, data, len(data))
 
     def _encode_string(self, text: str) -> tuple[int, int]:
         data = text.encode("utf-8")
@@ -70,32 +122,40 @@ class PoWGenerator:
                 self.store, retptr, ptr_challenge, len_challenge,
                 ptr_prefix, len_prefix, float(difficulty)
             )
-            status_bytes = self._read_memory(retptr, 4)
-            if len(status_bytes) != 4: return None
-            status = struct.unpack("<i", status_bytes)[0]
+            # i32 status, 4 bytes of padding, then the f64 answer
+            status, value = struct.unpack_from("<ixxxxd", self._memory_buffer(), retptr)
             if status == 0: return None
-            value_bytes = self._read_memory(retptr + 8, 8)
-            if len(value_bytes) != 8: return None
-            value = struct.unpack("<d", value_bytes)[0]
             return int(value)
         finally:
             self.add_to_stack(self.store, 16)
 
+# A wasm store must not be shared between threads, so every pool worker
+# lazily instantiates its own generator from the shared module.
+POW_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=os.cpu_count(), thread_name_prefix="pow"
+)
+_pow_local = threading.local()
+
+def _solve_pow(challenge_data: dict) -> int | None:
+    generator = getattr(_pow_local, "generator", None)
+    if generator is None:
+        generator = _pow_local.generator = PoWGenerator(POW_ENGINE, POW_MODULE)
+    return generator.calculate_answer(challenge_data)
+
 class DeepSeekClient:
     def __init__(self, token: str, session: httpx.AsyncClient):
         if not token:
             raise ValueError("An authorization token is required.")
         self.token = token
         self.headers = {**BASE_HEADERS, "authorization": f"Bearer {self.token}"}
-        self.pow_generator = PoWGenerator(WASM_FILE_PATH)
         self.session = session
-        print("DeepSeekClient initialized.")
+        logger.debug("DeepSeekClient initialized.")
 
     async def _create_session(self) -> str | None:
-        print("Creating new chat session...")
+        logger.debug("Creating new chat session...")
         try:
             resp = await self.session.post(
-                f"{DEEPSEEK_API_BASE}/chat_session/create",
+                _URL_SESSION_CREATE,
                 headers=self.headers,
                 json={"character_id": None},
             )
@@ -103,64 +163,65 @@ class DeepSeekClient:
             data = resp.json()
             if data.get("code") == 0:
                 session_id = data["data"]["biz_data"]["id"]
-                print(f"Session created: {session_id}")
+                logger.debug("Session created: %s", session_id)
                 return session_id
             else:
-                print(f"Failed to create session: {data.get('msg')}")
+                logger.warning("Failed to create session: %s", data.get("msg"))
                 return None
         except Exception as e:
-            print(f"Error creating session: {e}")
+            logger.error("Error creating session: %s", e)
             return None
 
     async def _get_and_solve_pow(self) -> str | None:
-        print("Getting and solving PoW challenge...")
+        logger.debug("Getting and solving PoW challenge...")
         try:
             resp = await self.session.post(
-                f"{DEEPSEEK_API_BASE}/chat/create_pow_challenge",
+                _URL_POW,
                 headers=self.headers,
                 json={"target_path": "/api/v0/chat/completion"},
             )
             resp.raise_for_status()
             data = resp.json()
             if data.get("code") != 0:
-                print(f"Failed to get PoW challenge: {data.get('msg')}")
+                logger.warning("Failed to get PoW challenge: %s", data.get("msg"))
                 return None
             
             challenge_data = data["data"]["biz_data"]["challenge"]
-            answer = self.pow_generator.calculate_answer(challenge_data)
+            answer = await asyncio.get_running_loop().run_in_executor(
+                POW_POOL, _solve_pow, challenge_data
+            )
             if answer is None:
-                print("Failed to solve PoW challenge.")
+                logger.warning("Failed to solve PoW challenge.")
                 return None
             
-            print(f"PoW challenge solved. Answer: {answer}")
+            logger.debug("PoW challenge solved. Answer: %s", answer)
 
-            pow_dict = {
+            # orjson output is already compact and in insertion order
+            pow_json = orjson.dumps({
                 "algorithm": challenge_data["algorithm"],
                 "challenge": challenge_data["challenge"],
                 "salt": challenge_data["salt"],
                 "answer": answer,
                 "signature": challenge_data["signature"],
                 "target_path": challenge_data["target_path"],
-            }
-            pow_str = json.dumps(pow_dict, separators=(",", ":"))
-            encoded_pow = base64.b64encode(pow_str.encode("utf-8")).decode("utf-8")
-            return encoded_pow
+            })
+            return base64.b64encode(pow_json).decode("ascii")
 
         except Exception as e:
-            print(f"Error during PoW process: {e}")
+            logger.error("Error during PoW process: %s", e)
             return None
 
     async def _delete_session(self, session_id: str):
-        print(f"\nDeleting session: {session_id}")
+        logger.debug("Deleting session: %s", session_id)
         try:
             await self.session.post(
-                f"{DEEPSEEK_API_BASE}/chat_session/delete",
+                _URL_SESSION_DELETE,
                 headers=self.headers,
                 json={"chat_session_id": session_id},
             )
-            print("Session deleted successfully.")
+            logger.debug("Session deleted successfully.")
         except Exception as e:
-            print(f"Error deleting session: {e}")
+            logger.error("Error deleting session: %s", e)
 
     @asynccontextmanager
     async def managed_chat_session(self):
@@ -180,7 +241,8 @@ class DeepSeekClient:
         if not pow_response:
             return
             
-        chat_headers = {**self.headers, "x-ds-pow-response": pow_response}
+        chat_headers = self.headers.copy()
+        chat_headers["x-ds-pow-response"] = pow_response
         payload = {
             "chat_session_id": session_id,
             "parent_message_id": None,
@@ -190,12 +252,12 @@ class DeepSeekClient:
             "search_enabled": False,
         }
 
-        print(f"\n--- Sending prompt (Thinking: {thinking_enabled}) ---")
+        logger.debug("Sending prompt (Thinking: %s)", thinking_enabled)
         
         try:
             async with self.session.stream(
                 "POST",
-                f"{DEEPSEEK_API_BASE}/chat/completion",
+                _URL_COMPLETION,
                 headers=chat_headers,
                 json=payload,
                 timeout=None
@@ -203,41 +265,40 @@ class DeepSeekClient:
                 resp.raise_for_status()
                 
                 is_thinking = False
-                buffer = ""
+                buffer = bytearray()
                 async for content_chunk in resp.aiter_bytes():
-                    buffer += content_chunk.decode('utf-8', errors='ignore')
-                    while '\n\n' in buffer:
-                        line, buffer = buffer.split('\n\n', 1)
-                        if not line.startswith("data:"):
+                    # Only the tail that straddles the previous chunk is rescanned
+                    scan_from = max(len(buffer) - 1, 0)
+                    buffer += content_chunk
+                    start = 0
+                    while (end := buffer.find(b"\n\n", scan_from)) != -1:
+                        line = buffer[start:end]
+                        start = scan_from = end + 2
+                        if not line.startswith(_DATA_PREFIX):
                             continue
-                            
-                        data_str = line[6:].strip()
-                        if data_str == "[DONE]":
+                        if line == _DONE:
                             return
                             
                         try:
-                            chunk = json.loads(data_str)
+                            # orjson skips the whitespace after the prefix itself
+                            chunk = orjson.loads(line[5:])
                             path = chunk.get("p")
                             value = chunk.get("v")
 
-                            if path == "response/thinking_content":
-                                if not is_thinking:
-                                    is_thinking = True
-                                    yield {"type": "thinking_start"}
-                                yield {"type": "thinking", "content": value}
-                            elif path == "response/content":
-                                if is_thinking:
-                                    is_thinking = False
-                                    yield {"type": "answer_start"}
-                                yield {"type": "content", "content": value}
-                            elif value is not None and isinstance(value, str) and "p" not in chunk:
-                                if is_thinking:
-                                    yield {"type": "thinking", "content": value}
-                                else:
-                                    yield {"type": "content", "content": value}
-
-                        except (json.JSONDecodeError, AttributeError):
+                            thinking = _PATH_IS_THINKING.get(path)
+                            if thinking is None:
+                                # Path-less string frames continue the current part
+                                if "p" in chunk or not isinstance(value, str):
+                                    continue
+                                thinking = is_thinking
+                            elif thinking is not is_thinking:
+                                is_thinking = thinking
+                                yield Chunk("thinking_start" if thinking else "answer_start")
+                            yield Chunk("thinking" if thinking else "content", value)
+
+                        except (orjson.JSONDecodeError, AttributeError, TypeError):
                             continue
+                    del buffer[:start]
         except Exception as e:
-            print(f"\nError during chat completion: {e}")
-            yield {"type": "error", "content": str(e)}
+            logger.error("Error during chat completion: %s", e)
+            yield Chunk("error", str(e))
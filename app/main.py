@@ -1,15 +1,31 @@
 from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
+from contextlib import AsyncExitStack
+from functools import partial
+import hashlib
 import httpx
+import logging
+import orjson
+import os
 import time
 
+# Configured before the app modules below are imported, so their
+# import-time messages already go through it.
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "WARNING").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
 from .config import config
 from .accounts import account_manager
-from .deepseek import DeepSeekClient
-from .openai_adapter import convert_to_openai_stream
+from .deepseek import DeepSeekClient, POW_POOL, USER_AGENT
+from .openai_adapter import convert_to_openai_stream, SSE_HEADERS
+from .orjson_response import ORJSONResponse
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # CORS Middleware Configuration
 origins = ["*"]  # In production, you should restrict this to specific domains.
@@ -22,7 +38,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-http_client = httpx.AsyncClient(verify=False)
+# httpx does not support impersonate, but we can set headers
+http_client = httpx.AsyncClient(
+    http2=True,
+    verify=False,
+    limits=httpx.Limits(max_connections=500, max_keepalive_connections=200, keepalive_expiry=30.0),
+    timeout=httpx.Timeout(connect=5.0, read=300.0, write=10.0, pool=5.0),
+    headers={"User-Agent": USER_AGENT},
+)
 
 @app.on_event("startup")
 async def startup_event():
@@ -31,84 +54,122 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     await http_client.aclose()
+    POW_POOL.shutdown(wait=False, cancel_futures=True)
+
+# One client per account; account objects and their tokens live as long as the process
+_clients: dict[int, DeepSeekClient] = {}
+
+def get_client(account) -> DeepSeekClient:
+    client = _clients.get(id(account))
+    if client is None:
+        client = _clients[id(account)] = DeepSeekClient(token=account.token, session=http_client)
+    return client
+
+async def _open_chat(cleanup: AsyncExitStack):
+    account = await cleanup.enter_async_context(account_manager.managed_account())
+    client = get_client(account)
+    session_id = await cleanup.enter_async_context(client.managed_chat_session())
+    if not session_id:
+        raise HTTPException(status_code=500, detail="Failed to create chat session.")
+    return client, session_id
+
+async def _close_quietly(cleanup: AsyncExitStack):
+    # Runs after the response is sent; errors must not surface to the client
+    try:
+        await cleanup.aclose()
+    except Exception:
+        logger.exception("Error while releasing account and chat session.")
 
 # --- API Key Authentication ---
+# Keys are matched by SHA-256 digest, so the set lookup leaks nothing about
+# how much of a guessed key matches a real one.
+_API_KEY_DIGESTS = frozenset(hashlib.sha256(key.encode()).digest() for key in config.api_keys)
+
 async def verify_api_key(request: Request):
     auth_header = request.headers.get("Authorization", "")
-    if not auth_header.startswith("Bearer "):
+    if len(auth_header) < 8 or auth_header[:7] != "Bearer ":
         raise HTTPException(status_code=401, detail="Missing Bearer token.")
     
-    token = auth_header.split(" ")[1]
-    if not config.api_keys:
-        print("Warning: No api_keys configured. Allowing all requests.")
+    token = auth_header[7:]
+    if not _API_KEY_DIGESTS:
+        logger.warning("No api_keys configured. Allowing all requests.")
         return
-    if token not in config.api_keys:
+    if hashlib.sha256(token.encode()).digest() not in _API_KEY_DIGESTS:
         raise HTTPException(status_code=403, detail="Invalid API Key.")
 
 # --- OpenAI Compatible Endpoints ---
+# The model list is static, so it is serialized once
+_MODELS_BODY = orjson.dumps({
+    "object": "list",
+    "data": [
+        {"id": "deepseek-chat", "object": "model", "owned_by": "deepseek"},
+        {"id": "deepseek-thinking", "object": "model", "owned_by": "deepseek"}
+    ]
+})
+
 @app.get("/v1/models", dependencies=[Depends(verify_api_key)])
 async def list_models():
-    return {
-        "object": "list",
-        "data": [
-            {"id": "deepseek-chat", "object": "model", "owned_by": "deepseek"},
-            {"id": "deepseek-thinking", "object": "model", "owned_by": "deepseek"}
-        ]
-    }
+    return Response(content=_MODELS_BODY, media_type="application/json")
 
 @app.post("/v1/chat/completions", dependencies=[Depends(verify_api_key)])
 async def chat_completions(request: Request):
     try:
-        request_data = await request.json()
+        request_data = orjson.loads(await request.body())
     except Exception:
-        print("Client disconnected before request body was received.")
-        return JSONResponse(status_code=400, content={"error": "Client disconnected."})
+        logger.info("Client disconnected before request body was received.")
+        return ORJSONResponse(status_code=400, content={"error": "Client disconnected."})
 
     model = request_data.get("model", "deepseek-chat")
     
     messages = request_data.get("messages", [])
-    prompt_parts = []
-    for message in messages:
-        role = message.get("role")
-        content = message.get("content")
-        if role and content:
-            prompt_parts.append(f"{role}: {content}")
-    prompt = "\n".join(prompt_parts)
+    prompt = "\n".join(
+        f"{m['role']}: {m['content']}" for m in messages if m.get("role") and m.get("content")
+    )
 
     thinking_enabled = "thinking" in model if "thinking_enabled" not in request_data else request_data["thinking_enabled"]
 
-    if request_data.get("stream", False):
-        async def stream_logic():
-            async with account_manager.managed_account() as account:
-                client = DeepSeekClient(token=account.token, session=http_client)
-                async with client.managed_chat_session() as session_id:
-                    if not session_id:
-                        return
-                    raw_stream = client.chat_stream(session_id, prompt, thinking_enabled)
-                    openai_stream = convert_to_openai_stream(raw_stream, model)
-                    async for chunk in openai_stream:
-                        yield chunk
-        return StreamingResponse(stream_logic(), media_type="text/event-stream")
-    else:
-        full_content = ""
-        async with account_manager.managed_account() as account:
-            client = DeepSeekClient(token=account.token, session=http_client)
-            async with client.managed_chat_session() as session_id:
-                if not session_id:
-                    raise HTTPException(status_code=500, detail="Failed to create chat session.")
-                
-                async for chunk in client.chat_stream(session_id, prompt, thinking_enabled):
-                    if chunk.get("type") == "content":
-                        full_content += chunk.get("content", "")
+    # The account and chat session are acquired before any response is sent,
+    # so a missing session can still be answered with a 500. Streaming
+    # clients therefore see no headers while they wait for a free account.
+    cleanup = AsyncExitStack()
+    try:
+        client, session_id = await _open_chat(cleanup)
+        raw_stream = client.chat_stream(session_id, prompt, thinking_enabled)
+        if request_data.get("stream", False):
+            close = partial(_close_quietly, cleanup)
+            return StreamingResponse(
+                convert_to_openai_stream(raw_stream, model, on_close=close),
+                media_type="text/event-stream",
+                headers=SSE_HEADERS,
+                # Covers a disconnect before the body is first iterated, when
+                # the adapter's finally never runs; a no-op otherwise.
+                background=BackgroundTask(close),
+            )
+
+        parts: list[str] = []
+        async for chunk in raw_stream:
+            if chunk.type == "content":
+                parts.append(chunk.content)
+        full_content = "".join(parts)
         
-        response_data = {
-            "id": f"chatcmpl-{int(time.time())}",
+        now = int(time.time())
+        # full_content dominates the payload; encode it directly, with no
+        # response-class or encoder pass in between
+        body = orjson.dumps({
+            "id": f"chatcmpl-{now}",
             "object": "chat.completion",
-            "created": int(time.time()),
+            "created": now,
             "model": model,
             "choices": [{"message": {"role": "assistant", "content": full_content}, "index": 0, "finish_reason": "stop"}]
-        }
-        return JSONResponse(content=response_data)
+        })
+    except BaseException:
+        await cleanup.aclose()
+        raise
+    return Response(
+        content=body,
+        media_type="application/json",
+        background=BackgroundTask(_close_quietly, cleanup),
+    )
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,48 +1,163 @@
-import json
+import asyncio
+import orjson
 import time
 
-async def convert_to_openai_stream(deepseek_stream, model_id: str):
-    completion_id = f"chatcmpl-{int(time.time())}"
-    created_time = int(time.time())
-    
-    is_thinking = False
-    
-    async for chunk in deepseek_stream:
-        chunk_type = chunk.get("type")
-        content = chunk.get("content")
-        
-        if not chunk_type or not content:
-            continue
+from .deepseek import Chunk
 
-        delta = {"role": "assistant", "content": None, "reasoning_content": None}
-        
-        if chunk_type == "thinking_start":
-            is_thinking = True
-            delta["reasoning_content"] = "[Thinking] "
-        elif chunk_type == "answer_start":
-            is_thinking = False
-            delta["content"] = "" # Start of answer
-        elif chunk_type == "thinking":
-            delta["reasoning_content"] = content
-        elif chunk_type == "content":
-            delta["content"] = content
-        
-        openai_chunk = {
-            "id": completion_id,
-            "object": "chat.completion.chunk",
-            "created": created_time,
-            "model": model_id,
-            "choices": [{"delta": delta, "index": 0, "finish_reason": None}]
-        }
-        yield "data: " + json.dumps(openai_chunk) + "\n\n"
+# Text fragments arriving within this many seconds of each other are merged
+# into one SSE frame, up to roughly this many characters per frame.
+COALESCE_WINDOW = 0.005
+COALESCE_MAX_CHARS = 256
+# An SSE comment is sent after this many idle seconds so proxies keep the
+# connection open (e.g. while the PoW challenge is being solved).
+HEARTBEAT_INTERVAL = 15.0
+# Fragments buffered ahead of the client before upstream reads are paused
+PUMP_QUEUE_SIZE = 64
+# Stop reverse proxies (nginx) from buffering the event stream
+SSE_HEADERS = {"X-Accel-Buffering": "no", "Cache-Control": "no-cache", "Connection": "keep-alive"}
 
-    # Send final chunk
-    final_chunk = {
+_TEXT_TYPES = ("thinking", "content")
+_END = object()
+_HEARTBEAT = object()
+
+async def _pump(source, queue: asyncio.Queue):
+    try:
+        async for chunk in source:
+            await queue.put(chunk)
+    finally:
+        # A cancelled pump has no reader left to wait for the marker
+        if not asyncio.current_task().cancelling():
+            await queue.put(_END)
+
+async def _coalesce(deepseek_stream):
+    # The upstream generator runs in its own task and feeds a queue, so
+    # waiting on the merge window never cancels it mid-read.
+    queue = asyncio.Queue(maxsize=PUMP_QUEUE_SIZE)
+    pump = asyncio.create_task(_pump(deepseek_stream, queue))
+    pending_type = None
+    pending = []
+    size = 0
+    try:
+        while True:
+            # Buffered fragments are drained without arming a timer; only an
+            # empty queue waits for the merge window or the heartbeat.
+            if not queue.empty():
+                chunk = queue.get_nowait()
+            else:
+                try:
+                    chunk = await asyncio.wait_for(
+                        queue.get(), COALESCE_WINDOW if pending else HEARTBEAT_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    if not pending:
+                        yield _HEARTBEAT
+                        continue
+                    chunk = None
+
+            # Upstream values are not type-checked; anything but text passes through
+            mergeable = (
+                isinstance(chunk, Chunk)
+                and chunk.type in _TEXT_TYPES
+                and isinstance(chunk.content, str)
+                and chunk.content
+            )
+            if pending and (not mergeable or chunk.type != pending_type):
+                yield Chunk(pending_type, "".join(pending))
+                pending.clear()
+                size = 0
+            if chunk is None:
+                continue
+            if chunk is _END:
+                break
+
+            if mergeable:
+                pending_type = chunk.type
+                pending.append(chunk.content)
+                size += len(chunk.content)
+                if size >= COALESCE_MAX_CHARS:
+                    yield Chunk(pending_type, "".join(pending))
+                    pending.clear()
+                    size = 0
+            else:
+                yield chunk
+        await pump
+    finally:
+        # Wait for the upstream response to close before the caller tears
+        # down the chat session and account it belongs to.
+        if not pump.done():
+            pump.cancel()
+            try:
+                await pump
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+        elif not pump.cancelled():
+            # Closed before the consumer reached a failure; retrieve it so
+            # asyncio does not report it as never retrieved.
+            pump.exception()
+
+# Chunk type -> builder of the OpenAI delta; only the populated field is sent.
+# A builder returns None when the chunk carries nothing worth a frame.
+def _content_delta(content):
+    if not content:
+        return None
+    return {"role": "assistant", "content": content}
+
+def _thinking_delta(content):
+    if not content:
+        return None
+    return {"role": "assistant", "reasoning_content": content}
+
+def _thinking_start_delta(content):
+    return {"role": "assistant", "reasoning_content": "[Thinking] "}
+
+def _answer_start_delta(content):
+    return {"role": "assistant", "content": ""}
+
+_DELTA_BUILDERS = {
+    "content": _content_delta,
+    "thinking": _thinking_delta,
+    "thinking_start": _thinking_start_delta,
+    "answer_start": _answer_start_delta,
+}
+
+async def convert_to_openai_stream(deepseek_stream, model_id: str, on_close=None):
+    created_time = int(time.time())
+    completion_id = f"chatcmpl-{created_time}"
+    # The leading fields never change within a stream, so they are encoded
+    # once and only the choices are serialized per chunk.
+    frame_head = b"data: " + orjson.dumps({
         "id": completion_id,
         "object": "chat.completion.chunk",
         "created": created_time,
         "model": model_id,
-        "choices": [{"delta": {}, "index": 0, "finish_reason": "stop"}]
-    }
-    yield "data: " + json.dumps(final_chunk) + "\n\n"
-    yield "data: [DONE]\n\n"
+    })[:-1] + b',"choices":'
+    
+    stream = _coalesce(deepseek_stream)
+    try:
+        async for chunk in stream:
+            if chunk is _HEARTBEAT:
+                yield b": ping\n\n"
+                continue
+            build_delta = _DELTA_BUILDERS.get(chunk.type)
+            if build_delta is None:
+                continue
+            delta = build_delta(chunk.content)
+            if delta is None:
+                continue
+        
+            choices = [{"delta": delta, "index": 0, "finish_reason": None}]
+            yield frame_head + orjson.dumps(choices) + b"}\n\n"
+    finally:
+        # Stops the upstream task as soon as the client goes away, then runs
+        # the caller's teardown on every exit path, including errors.
+        try:
+            await stream.aclose()
+        finally:
+            if on_close is not None:
+                await on_close()
+
+    # Send final chunk
+    choices = [{"delta": {}, "index": 0, "finish_reason": "stop"}]
+    yield frame_head + orjson.dumps(choices) + b"}\n\n"
+    yield b"data: [DONE]\n\n"